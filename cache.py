@@ -0,0 +1,91 @@
+"""
+Local cache of LLM fraud scores keyed by post text, model and prompt.
+"""
+import hashlib
+import sqlite3
+from typing import Dict, Iterable
+
+from config import INPUT_TEMPLATE, OPENROUTER_MODEL, SCORE_CACHE_PATH, SYSTEM_PROMPT
+
+# A score is only valid for the model and prompt that produced it, so both are
+# folded into every key; changing either one leaves earlier entries unused.
+_PROMPT_HASH = hashlib.sha256((SYSTEM_PROMPT + INPUT_TEMPLATE).encode("utf-8")).hexdigest()
+_KEY_PREFIX = f"{OPENROUTER_MODEL}\0{_PROMPT_HASH}\0"
+
+
+def cache_key(text: str) -> str:
+    """
+    Compute the cache key for a post text under the current model and prompt.
+
+    Args:
+        text: Post text
+
+    Returns:
+        Hex-encoded SHA-256 digest of the model, prompt hash and text
+    """
+    return hashlib.sha256((_KEY_PREFIX + text).encode("utf-8")).hexdigest()
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(SCORE_CACHE_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS fraud_scores ("
+        "cache_key TEXT PRIMARY KEY, "
+        "fraud_probability REAL NOT NULL)"
+    )
+    return conn
+
+
+def get_cached_scores(keys: Iterable[str]) -> Dict[str, float]:
+    """
+    Look up previously computed fraud scores.
+
+    Args:
+        keys: Cache keys to look up
+
+    Returns:
+        Dictionary mapping each cached key to its fraud probability
+    """
+    keys = list(set(keys))
+    if not keys:
+        return {}
+
+    cached = {}
+    conn = _connect()
+    try:
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT cache_key, fraud_probability FROM fraud_scores "
+                f"WHERE cache_key IN ({placeholders})",
+                chunk
+            )
+            cached.update(rows)
+    finally:
+        conn.close()
+
+    return cached
+
+
+def save_scores(scores: Dict[str, float]) -> None:
+    """
+    Persist fraud scores so later runs can skip the LLM for these texts.
+
+    Args:
+        scores: Dictionary mapping cache keys to fraud probabilities
+    """
+    if not scores:
+        return
+
+    conn = _connect()
+    try:
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO fraud_scores (cache_key, fraud_probability) "
+                "VALUES (?, ?)",
+                scores.items()
+            )
+    finally:
+        conn.close()
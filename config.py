@@ -8,13 +8,17 @@ from dotenv import load_dotenv
 load_dotenv()
 
 # Batch sizes
-LLM_BATCH_SIZE = 10
+# The rubric (~1k tokens) is cached, so each extra item only costs its own
+# tokens; batches are also capped by estimated input tokens (len(text) // 4)
+# to stay well inside the model's context window.
+LLM_BATCH_SIZE = 20
+LLM_BATCH_MAX_TOKENS = 6000
 DB_BATCH_SIZE = 1000
 
 # Rate limiting
 MAX_CONCURRENT_REQUESTS = 2
 MAX_RETRIES = 3
-REQUEST_DELAY = 1.0  # Seconds between requests
+REQUEST_DELAY = 1.0  # Seconds over which MAX_CONCURRENT_REQUESTS may be sent
 
 # API Configuration
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
@@ -26,8 +30,10 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 SUPABASE_TABLE = os.getenv("SUPABASE_TABLE", "fraud_cases")
 
-# LLM Prompt Template
-PROMPT_TEMPLATE = """# TAREFA
+# LLM Prompts
+# SYSTEM_PROMPT is sent byte-identical on every call so providers can cache it;
+# only INPUT_TEMPLATE varies between batches.
+SYSTEM_PROMPT = """# TAREFA
 Você é um especialista em análise de fraudes e golpes. Sua tarefa é analisar textos curtos e atribuir uma probabilidade (0 a 1) de que o texto descreva alguém que EFETIVAMENTE SOFREU um golpe ou fraude.
 
 # DEFINIÇÃO DE GOLPE
@@ -120,11 +126,17 @@ Retorne APENAS um JSON válido no formato:
 - **A VÍTIMA PODE SER QUALQUER PESSOA**: Autor, familiar, amigo, conhecido, cliente, etc.
 - **VALORES NÃO PRECISAM estar explícitos**: O prejuízo pode ser descrito sem montantes específicos
 - **SÓ ALTA probabilidade quando houver indicação clara de PREJUÍZO REAL sofrido por alguém específico**
-- Use a escala completa de 0.0 a 1.0 com granularidade
+- Use a escala completa de 0.0 a 1.0 com granularidade"""
 
-INPUT:
+INPUT_TEMPLATE = """INPUT:
 DATA_PLACEHOLDER"""
 
+# Split once at import so each batch only concatenates around the data
+INPUT_PREFIX, INPUT_SUFFIX = INPUT_TEMPLATE.split("DATA_PLACEHOLDER", 1)
+
+# Local score cache (SQLite file keyed by text hash)
+SCORE_CACHE_PATH = os.getenv("SCORE_CACHE_PATH", "score_cache.sqlite3")
+
 # Request timeout (seconds)
 REQUEST_TIMEOUT = 60
 
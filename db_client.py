@@ -1,11 +1,12 @@
 """
 File client for saving processed data to text files.
 """
-import json
 import os
 from datetime import datetime
 from typing import List, Dict, Any
 
+import orjson
+
 
 def save_to_txt(fraud_cases: List[Dict[str, Any]]) -> None:
     """
@@ -28,8 +29,10 @@ def save_to_txt(fraud_cases: List[Dict[str, Any]]) -> None:
     print(f"\n💾 Saving {len(fraud_cases)} fraud cases to {filename}...")
     
     try:
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(fraud_cases, f, indent=2, ensure_ascii=False)
+        # Serialize up front so a failure never leaves a truncated file behind
+        buf = orjson.dumps(fraud_cases, option=orjson.OPT_INDENT_2)
+        with open(filename, 'wb') as f:
+            f.write(buf)
         
         print(f"✓ Successfully saved {len(fraud_cases)} fraud cases to {filename}")
         
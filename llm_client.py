@@ -3,112 +3,253 @@ LLM client for processing data through OpenRouter API.
 """
 import asyncio
 import aiohttp
-import json
-from typing import List, Dict, Any
+import json5
+import orjson
+import random
+from aiolimiter import AsyncLimiter
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 
+from cache import cache_key, get_cached_scores, save_scores
 from config import (
+    LLM_BATCH_MAX_TOKENS,
     LLM_BATCH_SIZE,
     MAX_CONCURRENT_REQUESTS,
     MAX_RETRIES,
     OPENROUTER_API_KEY,
     OPENROUTER_API_URL,
     OPENROUTER_MODEL,
-    PROMPT_TEMPLATE,
+    INPUT_PREFIX,
+    INPUT_SUFFIX,
+    SYSTEM_PROMPT,
     REQUEST_TIMEOUT,
     REQUEST_DELAY,
 )
 
+# Static rubric, built once so its bytes never change between calls.
+# cache_control marks it as a cacheable prefix for providers that need an
+# explicit breakpoint (Anthropic via OpenRouter); others cache prefixes implicitly.
+SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": [
+        {
+            "type": "text",
+            "text": SYSTEM_PROMPT,
+            "cache_control": {"type": "ephemeral"}
+        }
+    ]
+}
+
+# HTTP statuses worth retrying: rate limiting and transient server errors
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def _retry_delay(error: Exception, attempt: int) -> Optional[float]:
+    """
+    Compute how long to wait before retrying a failed request.
+    
+    Args:
+        error: Error raised by the failed attempt
+        attempt: Zero-based index of the failed attempt
+        
+    Returns:
+        Delay in seconds, taken from Retry-After when the server sent one,
+        or None if the server asks for a wait longer than REQUEST_TIMEOUT
+    """
+    headers = getattr(error, "headers", None)
+    retry_after = headers.get("Retry-After") if headers else None
+    if retry_after:
+        try:
+            delay = max(float(retry_after), 0.0)
+        except ValueError:
+            pass  # HTTP-date form; fall back to exponential backoff
+        else:
+            # Don't let one worker of the fixed pool stall the whole run
+            return delay if delay <= REQUEST_TIMEOUT else None
+    return min((2 ** attempt) + random.random(), REQUEST_TIMEOUT)
+
+
+# Invisible characters some models emit around their JSON output
+_INVISIBLE_CHARS = dict.fromkeys(map(ord, "\ufeff\u200b\u200c\u200d\u2060"))
+
+
+def parse_fraud_scores(text: str) -> Dict[str, Any]:
+    """
+    Parse the LLM's JSON output, tolerating common formatting glitches.
+    
+    Strict parsing is tried first; on failure the text is re-parsed as JSON5,
+    which accepts trailing commas, single quotes and comments.
+    
+    Args:
+        text: JSON text with markdown fences already removed
+        
+    Returns:
+        Dictionary mapping item indices to fraud probabilities
+        
+    Raises:
+        ValueError: If the text is not valid JSON or JSON5
+    """
+    try:
+        return orjson.loads(text.encode())
+    except orjson.JSONDecodeError:
+        return json5.loads(text)
+
+
+def _failed_batch(batch_index: int, error: Exception) -> Dict[str, Any]:
+    print(f"✗ Batch {batch_index + 1} failed: {str(error)}")
+    return {
+        "success": False,
+        "batch_index": batch_index,
+        "error": str(error)
+    }
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Roughly estimate the number of tokens in a text (~4 characters per token).
+    
+    Args:
+        text: Text to measure
+        
+    Returns:
+        Estimated token count
+    """
+    return len(text) // 4 + 1
+
+
+def iter_batches(data: List[Dict[str, str]]) -> Iterator[Tuple[int, List[Dict[str, str]]]]:
+    """
+    Lazily pack items greedily into batches, in input order.
+    
+    A batch is closed once it holds LLM_BATCH_SIZE items or adding the next item
+    would exceed LLM_BATCH_MAX_TOKENS estimated tokens. An item larger than the
+    token budget still gets a batch of its own.
+    
+    Args:
+        data: List of data items to batch
+        
+    Yields:
+        Tuples of (global offset of the batch's first item, batch)
+    """
+    current = []
+    current_tokens = 0
+    global_offset = 0
+    for item in data:
+        tokens = estimate_tokens(item['text'])
+        if current and (
+            len(current) >= LLM_BATCH_SIZE
+            or current_tokens + tokens > LLM_BATCH_MAX_TOKENS
+        ):
+            yield global_offset, current
+            global_offset += len(current)
+            current = []
+            current_tokens = 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        yield global_offset, current
+
 
 async def process_batch_with_llm(
     session: aiohttp.ClientSession,
     batch: List[Dict[str, str]],
-    semaphore: asyncio.Semaphore,
-    batch_index: int
+    limiter: AsyncLimiter,
+    batch_index: int,
+    global_offset: int
 ) -> Dict[str, Any]:
     """
     Process a batch of items through the LLM with rate limiting.
     
+    Transient API errors (timeouts, 429 and 5xx responses) are retried up to
+    MAX_RETRIES attempts with jittered exponential backoff.
+    
     Args:
-        session: Aiohttp client session
+        session: Aiohttp client session (carries the auth headers)
         batch: List of data items to process
-        semaphore: Semaphore for rate limiting
+        limiter: Token-bucket limiter shared by all batches
         batch_index: Index of the current batch
+        global_offset: Position of the batch's first item in the full input
         
     Returns:
         Dictionary with processing results
     """
-    async with semaphore:  # Rate limiting
-        # Format data for the prompt (global index and text)
-        global_offset = batch_index * LLM_BATCH_SIZE
-        formatted_data = "\n".join([
-            f"<{global_offset + i}>{item['text']}</{global_offset + i}>" 
-            for i, item in enumerate(batch)
-        ])
-        
-        prompt = PROMPT_TEMPLATE.replace("DATA_PLACEHOLDER", formatted_data)
-        
-        # Prepare API payload
-        payload = {
-            "model": OPENROUTER_MODEL,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        }
-        
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        # Add delay to avoid rate limiting
-        await asyncio.sleep(REQUEST_DELAY)
+    # Format data for the prompt (global index and text)
+    parts = []
+    append = parts.append
+    for i, item in enumerate(batch):
+        idx = global_offset + i
+        append(f"<{idx}>{item['text']}</{idx}>")
+    formatted_data = "\n".join(parts)
+    
+    prompt = INPUT_PREFIX + formatted_data + INPUT_SUFFIX
+    
+    # Prepare API payload (static system prefix first, batch data last)
+    payload = {
+        "model": OPENROUTER_MODEL,
+        "messages": [
+            SYSTEM_MESSAGE,
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    }
+    
+    for attempt in range(MAX_RETRIES):
+        try:
+            async with limiter:  # Rate limiting
+                async with session.post(
+                    OPENROUTER_API_URL,
+                    json=payload,
+                    timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+                ) as response:
+                    response.raise_for_status()
+                    result = await response.json()
+        except (aiohttp.ClientResponseError, asyncio.TimeoutError) as e:
+            status = getattr(e, "status", None)  # None for timeouts
+            if attempt < MAX_RETRIES - 1 and (status is None or status in RETRYABLE_STATUSES):
+                delay = _retry_delay(e, attempt)
+                if delay is None:
+                    print(f"Batch {batch_index + 1}: Retry-After exceeds {REQUEST_TIMEOUT}s, not retrying")
+                    return _failed_batch(batch_index, e)
+                print(f"⟳ Batch {batch_index + 1} attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            return _failed_batch(batch_index, e)
+        except Exception as e:
+            return _failed_batch(batch_index, e)
         
         try:
-            async with session.post(
-                OPENROUTER_API_URL,
-                json=payload,
-                headers=headers,
-                timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
-            ) as response:
-                response.raise_for_status()
-                result = await response.json()
-                
-                # Extract and parse LLM response
-                llm_response = result["choices"][0]["message"]["content"]
-                
-                # Strip markdown code blocks if present
-                cleaned_response = llm_response.strip()
-                if cleaned_response.startswith("```"):
-                    lines = cleaned_response.split('\n')
-                    lines = lines[1:]  # Remove first line (```json or ```)
-                    if lines and lines[-1].strip() == "```":
-                        lines = lines[:-1]  # Remove last line (```)
-                    cleaned_response = '\n'.join(lines).strip()
-                
-                try:
-                    fraud_scores = json.loads(cleaned_response)
-                    
-                    return {
-                        "success": True,
-                        "batch_index": batch_index,
-                        "fraud_scores": fraud_scores
-                    }
-                except json.JSONDecodeError as e:
-                    # If JSON parsing fails, show the cleaned response for debugging
-                    print(f"JSON parse error for batch {batch_index + 1}:")
-                    print(f"Cleaned response: {cleaned_response[:200]}...")
-                    raise e
+            # Extract and parse LLM response
+            llm_response = result["choices"][0]["message"]["content"]
+            
+            # Strip invisible characters and markdown code blocks if present
+            cleaned_response = llm_response.translate(_INVISIBLE_CHARS).strip()
+            if cleaned_response.startswith("```"):
+                # Remove first line (```json or ```)
+                newline = cleaned_response.find('\n')
+                cleaned_response = cleaned_response[newline + 1:] if newline != -1 else ""
+                if cleaned_response.endswith("```"):
+                    cleaned_response = cleaned_response[:-3]  # Remove closing fence
+                cleaned_response = cleaned_response.strip()
+            
+            try:
+                fraud_scores = parse_fraud_scores(cleaned_response)
                 
+                return {
+                    "success": True,
+                    "batch_index": batch_index,
+                    "global_offset": global_offset,
+                    "batch_size": len(batch),
+                    "fraud_scores": fraud_scores
+                }
+            except ValueError as e:
+                # If JSON parsing fails, show the cleaned response for debugging
+                print(f"JSON parse error for batch {batch_index + 1}:")
+                print(f"Cleaned response: {cleaned_response[:200]}...")
+                raise e
+            
         except Exception as e:
-            print(f"✗ Batch {batch_index + 1} failed: {str(e)}")
-            return {
-                "success": False,
-                "batch_index": batch_index,
-                "error": str(e)
-            }
+            return _failed_batch(batch_index, e)
 
 
 async def process_all_batches(data: List[Dict[str, str]]) -> List[Dict[str, Any]]:
@@ -121,30 +262,118 @@ async def process_all_batches(data: List[Dict[str, str]]) -> List[Dict[str, Any]
     Returns:
         List of successful processing results
     """
-    # Split data into batches
-    batches = [data[i:i + LLM_BATCH_SIZE] for i in range(0, len(data), LLM_BATCH_SIZE)]
+    # Reuse scores from previous runs; only unseen texts go to the LLM
+    keys = [cache_key(item['text']) for item in data]
+    cached_scores = get_cached_scores(keys)
+    uncached_indices = [i for i, h in enumerate(keys) if h not in cached_scores]
+    uncached_data = [data[i] for i in uncached_indices]
+    
+    if cached_scores:
+        print(f"\n♻ Reusing cached scores for {len(data) - len(uncached_data)} items")
+    if uncached_data:
+        avg_tokens = sum(estimate_tokens(item['text']) for item in uncached_data) / len(uncached_data)
+        print(f"\n📏 ~{avg_tokens:.0f} estimated tokens per item")
+    print(f"\n📊 Processing {len(uncached_data)} items in batches "
+          f"of ≤{LLM_BATCH_SIZE} items / ~{LLM_BATCH_MAX_TOKENS} tokens")
+    print(f"🔒 Rate limit: {MAX_CONCURRENT_REQUESTS} requests per {REQUEST_DELAY}s\n")
+    
+    # Token bucket: bursts up to MAX_CONCURRENT_REQUESTS, refilled every REQUEST_DELAY seconds
+    limiter = AsyncLimiter(MAX_CONCURRENT_REQUESTS, REQUEST_DELAY)
+    
+    # Requests in flight at once. The connector and the worker pool are both
+    # sized from this so the connection pool can never be the bottleneck: a
+    # request queued for a connection has already spent a rate token and is
+    # already counting down its REQUEST_TIMEOUT.
+    max_in_flight = MAX_CONCURRENT_REQUESTS
     
-    print(f"\n📊 Processing {len(data)} items in {len(batches)} batches of {LLM_BATCH_SIZE}")
-    print(f"🔒 Rate limit: {MAX_CONCURRENT_REQUESTS} concurrent requests\n")
+    # Size the pool to the in-flight bound and send auth headers as session defaults
+    connector = aiohttp.TCPConnector(
+        limit=max_in_flight,
+        limit_per_host=max_in_flight,
+        ttl_dns_cache=300,
+        keepalive_timeout=60
+    )
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json"
+    }
     
-    # Create semaphore for rate limiting
-    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    # Batches are built on demand and consumed by a fixed pool of workers, so
+    # only the batches currently being sent are held in memory
+    batches = enumerate(iter_batches(uncached_data))
+    results = []
+    
+    async def worker() -> None:
+        for idx, (global_offset, batch) in batches:
+            results.append(
+                await process_batch_with_llm(session, batch, limiter, idx, global_offset)
+            )
     
     # Process all batches concurrently (but rate-limited)
-    async with aiohttp.ClientSession() as session:
-        tasks = [
-            process_batch_with_llm(session, batch, semaphore, idx)
-            for idx, batch in enumerate(batches)
-        ]
-        results = await asyncio.gather(*tasks)
+    async with aiohttp.ClientSession(connector=connector, headers=headers) as session:
+        await asyncio.gather(*[worker() for _ in range(max_in_flight)])
     
-    # Filter successful results
-    successful_results = [r for r in results if r and r["success"]]
-    failed_results = [r for r in results if r and not r["success"]]
+    # Map LLM indices (positions in uncached_data) back to positions in data.
+    # The scores are raw model output, so entries that are not a valid
+    # index/probability pair are skipped instead of aborting the whole run.
+    new_scores = {}
+    successful_results = []
+    failed_results = []
+    for result in results:
+        if not result:
+            continue
+        if not result["success"]:
+            failed_results.append(result)
+            continue
+        
+        fraud_scores = result["fraud_scores"]
+        if not isinstance(fraud_scores, dict):
+            failed_results.append(_failed_batch(
+                result["batch_index"],
+                TypeError(f"expected a JSON object, got {type(fraud_scores).__name__}")
+            ))
+            continue
+        
+        # Only indices this batch was given are accepted; a model that
+        # renumbers from 0 would otherwise overwrite other batches' items
+        batch_start = result["global_offset"]
+        batch_end = batch_start + result["batch_size"]
+        remapped = {}
+        skipped = 0
+        for idx, prob in fraud_scores.items():
+            try:
+                position = int(idx)
+                probability = float(prob)
+            except (TypeError, ValueError):
+                skipped += 1
+                continue
+            if not batch_start <= position < batch_end or not 0.0 <= probability <= 1.0:
+                skipped += 1
+                continue
+            original_idx = uncached_indices[position]
+            remapped[str(original_idx)] = probability
+            new_scores[keys[original_idx]] = probability
+        
+        if skipped:
+            print(f"⚠ Batch {result['batch_index'] + 1}: skipped {skipped} invalid score entries")
+        result["fraud_scores"] = remapped
+        successful_results.append(result)
     
-    print(f"\n✓ Successfully processed: {len(successful_results)}/{len(batches)} batches")
+    print(f"\n✓ Successfully processed: {len(successful_results)}/{len(results)} batches")
     if failed_results:
         print(f"✗ Failed batches: {len(failed_results)}")
     
+    save_scores(new_scores)
+    
+    if cached_scores:
+        successful_results.append({
+            "success": True,
+            "batch_index": None,
+            "fraud_scores": {
+                str(i): cached_scores[h]
+                for i, h in enumerate(keys)
+                if h in cached_scores
+            }
+        })
+    
     return successful_results
-
@@ -1,29 +1,36 @@
-import os
-import json
-import requests
-from dotenv import load_dotenv
-from supabase import create_client, Client
+"""
+Crawl Twitter and Reddit for PIX scam reports and run the fraud detection pipeline.
+"""
 import asyncio
-import json
 import os
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
-from config import validate_config, FRAUD_PROBABILITY_THRESHOLD
+import httpx
+import orjson
+from supabase import create_client, Client
+
+from config import (
+    validate_config,
+    DB_BATCH_SIZE,
+    FRAUD_PROBABILITY_THRESHOLD,
+    REQUEST_TIMEOUT,
+    SUPABASE_KEY,
+    SUPABASE_URL,
+)
 from llm_client import process_all_batches
 from db_client import save_to_txt
 
-load_dotenv()
-
 TWITTER_BEARER_TOKEN = os.getenv("TWITTER_BEARER_TOKEN")
 MAX_RESULTS = int(os.getenv("MAX_RESULTS", "100"))
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
 TWITTER_API_URL = "https://api.twitter.com/2/tweets/search/recent"
 REDDIT_SEARCH_URL = "https://www.reddit.com/search.json"
 
+# Shared Supabase client, created on first use
+_supabase: Optional[Client] = None
 
-def fetch_tweets(query, max_results=100):
+
+async def fetch_tweets_async(client, query, max_results=100):
     headers = {"Authorization": f"Bearer {TWITTER_BEARER_TOKEN}"}
     params = {
         "query": query,
@@ -33,7 +40,7 @@ def fetch_tweets(query, max_results=100):
         "user.fields": "username,location,name"
     }
 
-    response = requests.get(TWITTER_API_URL, headers=headers, params=params)
+    response = await client.get(TWITTER_API_URL, headers=headers, params=params)
     response.raise_for_status()
     data = response.json()
 
@@ -55,7 +62,15 @@ def fetch_tweets(query, max_results=100):
     return tweets
 
 
-def fetch_reddit_posts(query, max_results=100):
+async def _fetch_subreddit(client, subreddit, headers, params):
+    # Fetch from the subreddit's own search endpoint
+    subreddit_url = f"https://www.reddit.com/r/{subreddit}/search.json"
+    response = await client.get(subreddit_url, headers=headers, params=params)
+    response.raise_for_status()
+    return response.json()
+
+
+async def fetch_reddit_posts_async(client, query, max_results=100):
     headers = {"User-Agent": "pix-scam-detector/1.0"}
     params = {
         "q": query,
@@ -67,13 +82,13 @@ def fetch_reddit_posts(query, max_results=100):
     posts = []
     target_subreddits = ["ConselhosLegais", "golpe"]
     
-    for subreddit in target_subreddits:
-        # Fetch from each subreddit's search endpoint
-        subreddit_url = f"https://www.reddit.com/r/{subreddit}/search.json"
-        response = requests.get(subreddit_url, headers=headers, params=params)
-        response.raise_for_status()
-        data = response.json()
+    # Query all subreddits concurrently (multiplexed over one HTTP/2 connection)
+    responses = await asyncio.gather(*[
+        _fetch_subreddit(client, subreddit, headers, params)
+        for subreddit in target_subreddits
+    ])
 
+    for data in responses:
         for child in data.get("data", {}).get("children", []):
             post = child.get("data", {})
             text = post.get("title", "")
@@ -90,6 +105,26 @@ def fetch_reddit_posts(query, max_results=100):
     
     return posts[:max_results]
 
+def dedupe_posts(posts: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """
+    Drop posts whose text is byte-identical to an earlier post.
+    
+    Args:
+        posts: List of post dictionaries
+        
+    Returns:
+        Posts in original order, keeping the first occurrence of each text
+    """
+    seen = set()
+    unique_posts = []
+    for post in posts:
+        text = post["text"]
+        if text not in seen:
+            seen.add(text)
+            unique_posts.append(post)
+    return unique_posts
+
+
 def load_posts_from_txt(file_path: str) -> List[Dict[str, str]]:
     """
     Load posts from a JSON file containing an array of post objects.
@@ -103,8 +138,8 @@ def load_posts_from_txt(file_path: str) -> List[Dict[str, str]]:
     if not os.path.exists(file_path):
         raise FileNotFoundError(f"Input file not found: {file_path}")
     
-    with open(file_path, 'r', encoding='utf-8') as f:
-        posts = json.load(f)
+    with open(file_path, 'rb') as f:
+        posts = orjson.loads(f.read())
     
     print(f"📂 Loaded {len(posts)} posts from {file_path}")
     return posts
@@ -113,7 +148,8 @@ def load_posts_from_txt(file_path: str) -> List[Dict[str, str]]:
 def filter_by_fraud_probability(
     llm_results: List[Dict[str, Any]], 
     input_data: List[Dict[str, str]],
-    threshold: float = FRAUD_PROBABILITY_THRESHOLD
+    threshold: float = FRAUD_PROBABILITY_THRESHOLD,
+    score_indices: Optional[List[int]] = None
 ) -> List[Dict[str, Any]]:
     """
     Filter input data by fraud probability threshold.
@@ -122,6 +158,8 @@ def filter_by_fraud_probability(
         llm_results: Results from LLM processing (already parsed)
         input_data: Original input data array
         threshold: Minimum probability to consider as fraud (0.0 - 1.0)
+        score_indices: For each item in input_data, the index its score was
+                       reported under (used when duplicates were scored once)
         
     Returns:
         List of filtered data with fraud scores above threshold
@@ -133,20 +171,25 @@ def filter_by_fraud_probability(
         # Fraud scores are already parsed in llm_client
         all_fraud_scores.update(result['fraud_scores'])
     
-    # Filter indices above threshold
-    high_fraud_indices = [
-        int(idx) 
-        for idx, prob in all_fraud_scores.items() 
-        if float(prob) >= threshold
-    ]
+    # Fan scores of deduplicated items back out to every original position
+    if score_indices is not None:
+        all_fraud_scores = {
+            str(idx): all_fraud_scores[str(score_idx)]
+            for idx, score_idx in enumerate(score_indices)
+            if str(score_idx) in all_fraud_scores
+        }
     
-    # Build filtered dataset with fraud scores
+    # Filter by threshold and build the dataset in a single pass
+    threshold_f = float(threshold)
     filtered_data = []
-    for idx in high_fraud_indices:
-        if idx < len(input_data):
-            fraud_case = input_data[idx].copy()
-            fraud_case['fraud_probability'] = all_fraud_scores[str(idx)]
-            filtered_data.append(fraud_case)
+    n = len(input_data)
+    for idx_str, prob in all_fraud_scores.items():
+        p = float(prob)
+        if p < threshold_f:
+            continue
+        idx = int(idx_str)
+        if idx < n:
+            filtered_data.append({**input_data[idx], 'fraud_probability': p})
     
     print(f"\n🎯 Processing Summary:")
     print(f"  Total analyzed: {len(input_data)} items")
@@ -173,15 +216,33 @@ async def run_pipeline(input_data: List[Dict[str, str]]) -> None:
     # Validate configuration
     validate_config()
     
-    # Step 1: Process through LLM (fraud detection)
-    results = await process_all_batches(input_data)
+    # Step 1: Collapse byte-identical texts so each one is scored once
+    canonical_indices: Dict[str, int] = {}
+    unique_data = []
+    score_indices = []
+    for item in input_data:
+        text = item['text']
+        if text not in canonical_indices:
+            canonical_indices[text] = len(unique_data)
+            unique_data.append(item)
+        score_indices.append(canonical_indices[text])
+    
+    if len(unique_data) < len(input_data):
+        print(f"\n🧹 Skipping {len(input_data) - len(unique_data)} duplicate items")
     
-    # Step 2: Filter by fraud probability threshold
-    filtered_data = filter_by_fraud_probability(results, input_data)
+    # Step 2: Process through LLM (fraud detection)
+    results = await process_all_batches(unique_data)
     
-    # Step 3: Save high-probability fraud cases to text file
+    # Step 3: Filter by fraud probability threshold
+    filtered_data = filter_by_fraud_probability(
+        results, input_data, score_indices=score_indices
+    )
+    
+    # Step 4: Save high-probability fraud cases to text file and Supabase
     if filtered_data:
         save_to_txt(filtered_data)
+        print("\nSaving filtered data to Supabase...")
+        save_to_supabase(filtered_data)
     else:
         print("\n⚠ No fraud cases above threshold to save")
     
@@ -189,64 +250,74 @@ async def run_pipeline(input_data: List[Dict[str, str]]) -> None:
     print("✅ ETL Pipeline Complete")
     print("=" * 60)
 
-def save_to_supabase():
+def get_client() -> Client:
     """
-    Reads data from filtered_data.txt and saves it to the bot_occurences table in Supabase.
+    Return the shared Supabase client, creating it on first use.
+    
+    Returns:
+        Supabase client reused across calls
+    """
+    global _supabase
+    if _supabase is None:
+        _supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    return _supabase
+
+
+def save_to_supabase(data: List[Dict[str, Any]]) -> bool:
+    """
+    Save fraud cases to the bot_occurences table in Supabase.
+    
+    Args:
+        data: Fraud cases to insert
+        
+    Returns:
+        True if every record was inserted
     """
     if not SUPABASE_URL or not SUPABASE_KEY:
         print("Error: SUPABASE_URL or SUPABASE_KEY not set in .env")
         return False
 
-    # Create Supabase client
-    supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+    supabase = get_client()
 
-    # Read data from filtered_data.txt
-    try:
-        with open("filtered_data.txt", "r", encoding="utf-8") as f:
-            data = json.load(f)
-    except FileNotFoundError:
-        print("Error: filtered_data.txt not found")
-        return False
-    except json.JSONDecodeError:
-        print("Error: filtered_data.txt contains invalid JSON")
-        return False
+    # Insert data into bot_occurences table in chunks of DB_BATCH_SIZE
+    inserted = 0
+    for i in range(0, len(data), DB_BATCH_SIZE):
+        chunk = data[i:i + DB_BATCH_SIZE]
+        try:
+            supabase.table("bot_occurences").insert(chunk).execute()
+            inserted += len(chunk)
+        except Exception as e:
+            print(f"Error inserting DB batch {i // DB_BATCH_SIZE + 1} into Supabase: {e}")
 
-    # Insert data into bot_occurences table
-    try:
-        response = supabase.table("bot_occurences").insert(data).execute()
-        print(f"Successfully inserted {len(data)} record(s) into bot_occurences table")
-        return True
-    except Exception as e:
-        print(f"Error inserting data into Supabase: {e}")
-        return False
+    print(f"Successfully inserted {inserted}/{len(data)} record(s) into bot_occurences table")
+    return inserted == len(data)
 
 
-def main():
+async def main():
     if not TWITTER_BEARER_TOKEN:
         print("Error: TWITTER_BEARER_TOKEN not set")
         return
 
-    print(f"Fetching tweets...")
+    print("Fetching tweets and Reddit posts...")
     query = '"golpe do pix" OR "me roubaram no pix"'
-    tweets = fetch_tweets(query, max_results=MAX_RESULTS)
-    print(f"Found {len(tweets)} tweets")
-
-    print(f"Fetching Reddit posts...")
     reddit_query = "sofri golpe pix"
-    reddit_posts = fetch_reddit_posts(reddit_query, max_results=MAX_RESULTS)
+    async with httpx.AsyncClient(
+        http2=True, timeout=REQUEST_TIMEOUT, follow_redirects=True
+    ) as client:
+        tweets, reddit_posts = await asyncio.gather(
+            fetch_tweets_async(client, query, max_results=MAX_RESULTS),
+            fetch_reddit_posts_async(client, reddit_query, max_results=MAX_RESULTS)
+        )
+    print(f"Found {len(tweets)} tweets")
     print(f"Found {len(reddit_posts)} Reddit posts")
 
-    all_posts = tweets + reddit_posts
+    all_posts = dedupe_posts(tweets + reddit_posts)
 
     output_file = "posts_data.txt"
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(json.dumps(all_posts, indent=2, ensure_ascii=False))
-
-    print(f"\nTotal: {len(all_posts)} posts ({len(tweets)} tweets + {len(reddit_posts)} reddit)")
+    with open(output_file, "wb") as f:
+        f.write(orjson.dumps(all_posts, option=orjson.OPT_INDENT_2))
 
-    # Save filtered data to Supabase
-    print("\nSaving filtered data to Supabase...")
-    save_to_supabase()
+    print(f"\nTotal: {len(all_posts)} unique posts ({len(tweets)} tweets + {len(reddit_posts)} reddit)")
 
     input_file = os.path.join("input", "posts_data.txt")
     
@@ -254,7 +325,7 @@ def main():
         input_data = load_posts_from_txt(input_file)
         
         # Run the async pipeline
-        asyncio.run(run_pipeline(input_data))
+        await run_pipeline(input_data)
         
     except FileNotFoundError as e:
         print(f"\n❌ Error: {e}")
@@ -263,4 +334,4 @@ def main():
         print(f"\n❌ Unexpected error: {e}")
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())